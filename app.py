@@ -4,35 +4,148 @@ Flask веб-приложение для генерации изображени
 """
 
 import os
-import json
-from pathlib import Path
-from flask import Flask, render_template, request, jsonify, send_from_directory
+import re
+import uuid
+import heapq
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from types import MappingProxyType
+import orjson
+from cachetools import TTLCache, cached
+from flask import Flask, Response, abort, render_template, request, jsonify, send_from_directory, stream_with_context
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
 from dotenv import load_dotenv
-import threading
 
-from gigachat_enhancer import enhance_prompt
-from image_generator_core import generate_image
-
-# Загрузка переменных окружения
+# Загрузка переменных окружения (до импорта модулей, читающих настройки)
 load_dotenv()
 
+from gigachat_enhancer import enhance_prompt, get_gigachat_credentials
+from image_generator_core import (
+    generate_image, generate_images, get_proxy_api_key, get_openrouter_api_key
+)
+
+
+def _check_credentials():
+    """Проверяет ключи API при старте и один раз сообщает об отсутствующих"""
+    for get_key in (get_proxy_api_key, get_openrouter_api_key, get_gigachat_credentials):
+        try:
+            get_key()
+        except ValueError as e:
+            print(f"Внимание: {e}")
+
+
+_check_credentials()
+
+
+class ORJSONProvider(DefaultJSONProvider):
+    """JSON провайдер Flask на orjson (быстрее стандартного json)"""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
+app.config['PROPAGATE_EXCEPTIONS'] = True
 CORS(app)
 
-# Глобальные переменные для отслеживания прогресса
-generation_status = {
-    "status": "idle",  # idle, enhancing, generating, done, error
-    "progress": 0,
-    "message": "",
-    "image_path": None,
-    "original_prompt": "",
-    "enhanced_prompt": "",
-    "error": None
-}
+# Максимальное число изображений за один запрос
+MAX_IMAGES_PER_REQUEST = 4
+
+# Сколько задач хранить в памяти для /api/status
+MAX_STORED_JOBS = 100
+
+# Папки галереи сканируются параллельно, результат кэшируется на пару секунд
+GALLERY_PROVIDERS = ("proxyapi", "openrouter")
+GALLERY_CACHE_TTL = 2
+
+# Разбиение имени файла на числа и текст для естественной сортировки
+_NATURAL_SPLIT_RE = re.compile(r'(\d+)')
+
+_gallery_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="gallery")
+
+# Время кэширования изображений в браузере, секунды (год)
+IMAGE_MAX_AGE = 31536000
+
+# Интервал keep-alive комментариев в потоке событий, секунды
+EVENTS_KEEPALIVE = 15
+
+
+class JobState:
+    """Состояние одной задачи генерации"""
+
+    def __init__(self, original_prompt):
+        self._data = {
+            "status": "starting",  # starting, enhancing, generating, done, error
+            "progress": 0,
+            "message": "Начинаем генерацию...",
+            "image_path": None,
+            "image_paths": [],
+            "draft_image_path": None,
+            "original_prompt": original_prompt,
+            "enhanced_prompt": "",
+            "error": None
+        }
+        self._json = None  # Сериализованное состояние, сбрасывается при изменении
+        self._version = 0
+        self._changed = threading.Condition()
+
+    @property
+    def finished(self):
+        return self._data["status"] in ("done", "error")
+
+    def update(self, **fields):
+        """Обновляет поля состояния и будит подписчиков потока событий"""
+        with self._changed:
+            self._data.update(fields)
+            self._json = None
+            self._version += 1
+            self._changed.notify_all()
+
+    def to_json(self):
+        """
+        Возвращает состояние в JSON (bytes)
+        
+        Сериализация выполняется один раз на изменение и общая
+        для всех опросов и подписчиков потока событий.
+        """
+        with self._changed:
+            return self._to_json_locked()
+
+    def _to_json_locked(self):
+        if self._json is None:
+            self._json = orjson.dumps(self._data)
+        return self._json
+
+    def wait_for_update(self, version, timeout=None):
+        """
+        Ждет изменения состояния после версии version
+        
+        Returns:
+            tuple: (JSON состояния или None по таймауту, задача завершена, текущая версия)
+        """
+        with self._changed:
+            if not self._changed.wait_for(lambda: self._version != version, timeout):
+                return None, False, version
+            return self._to_json_locked(), self.finished, self._version
+
+
+# Задачи генерации по job_id
+JOBS = {}
+_jobs_lock = threading.Lock()
+
+# Отдельный event loop в фоновом потоке: все генерации идут в нём
+# конкурентно, не занимая потоки Flask на время запросов к API
+_loop = asyncio.new_event_loop()
+threading.Thread(target=_loop.run_forever, name="generation-loop", daemon=True).start()
 
 # Предустановленные стили
-STYLES = {
+STYLES = MappingProxyType({
     "none": {"name": "Без стиля", "suffix": ""},
     "photorealistic": {
         "name": "Фотореализм", 
@@ -58,7 +171,10 @@ STYLES = {
         "name": "Масляная живопись", 
         "suffix": "oil painting, classic art style, textured brushstrokes"
     }
-}
+})
+
+# Суффиксы стилей для быстрого поиска по ключу
+STYLE_SUFFIXES = MappingProxyType({key: style["suffix"] for key, style in STYLES.items()})
 
 
 @app.route('/')
@@ -70,101 +186,209 @@ def index():
 @app.route('/api/generate', methods=['POST'])
 def api_generate():
     """API эндпоинт для генерации изображений"""
-    global generation_status
-    
-    data = request.json
+    data = request.get_json(cache=False)
     user_prompt = data.get('prompt', '').strip()
     style_key = data.get('style', 'none')
     provider = data.get('provider', 'proxyapi')
+    draft = bool(data.get('draft', False))
     
     if not user_prompt:
         return jsonify({"error": "Промпт не может быть пустым"}), 400
     
-    # Сброс статуса
-    generation_status = {
-        "status": "starting",
-        "progress": 0,
-        "message": "Начинаем генерацию...",
-        "image_path": None,
-        "original_prompt": user_prompt,
-        "enhanced_prompt": "",
-        "error": None
-    }
+    try:
+        count = int(data.get('count', 1))
+    except (TypeError, ValueError):
+        return jsonify({"error": "Некорректное количество изображений"}), 400
+    count = max(1, min(count, MAX_IMAGES_PER_REQUEST))
     
-    # Запуск генерации в фоне
-    thread = threading.Thread(
-        target=generate_image_background,
-        args=(user_prompt, style_key, provider)
+    job_id = uuid.uuid4().hex
+    job = JobState(user_prompt)
+    _register_job(job_id, job)
+    
+    # Запуск генерации в фоновом event loop
+    asyncio.run_coroutine_threadsafe(
+        generate_image_background(job, user_prompt, style_key, provider, count, draft),
+        _loop
     )
-    thread.start()
     
-    return jsonify({"success": True, "message": "Генерация запущена"})
+    return jsonify({"success": True, "message": "Генерация запущена", "job_id": job_id})
+
+
+def _register_job(job_id, job):
+    """Сохраняет задачу, вытесняя самые старые завершённые"""
+    with _jobs_lock:
+        JOBS[job_id] = job
+        overflow = len(JOBS) - MAX_STORED_JOBS
+        if overflow > 0:
+            finished = [k for k, v in JOBS.items() if v.finished]
+            for old_id in finished[:overflow]:
+                del JOBS[old_id]
+
 
+async def _generate_draft(job, prompt, provider):
+    """Черновик по исходному промпту; ошибка не прерывает основную генерацию"""
+    try:
+        draft_path = await generate_image(prompt, provider)
+    except Exception as e:
+        print(f"Ошибка генерации черновика: {str(e)}")
+        return
+    job.update(draft_image_path=str(draft_path))
 
-def generate_image_background(user_prompt, style_key, provider):
+
+async def generate_image_background(job, user_prompt, style_key, provider, count=1, draft=False):
     """Фоновая генерация изображения"""
-    global generation_status
-    
+    draft_task = None
     try:
-        # Шаг 1: Улучшение промпта
-        generation_status["status"] = "enhancing"
-        generation_status["progress"] = 20
-        generation_status["message"] = "🤖 GigaChat улучшает промпт..."
+        # Шаг 1: Улучшение промпта (черновик по исходному промпту идет параллельно)
+        job.update(
+            status="enhancing",
+            progress=20,
+            message="🤖 GigaChat улучшает промпт..."
+        )
         
-        style = STYLES.get(style_key, STYLES["none"])
-        enhanced = enhance_prompt(user_prompt, style["suffix"])
+        style_suffix = STYLE_SUFFIXES.get(style_key, "")
+        if draft:
+            raw_prompt = f"{user_prompt}, {style_suffix}" if style_suffix else user_prompt
+            draft_task = asyncio.create_task(_generate_draft(job, raw_prompt, provider))
         
-        generation_status["enhanced_prompt"] = enhanced
-        generation_status["progress"] = 40
-        generation_status["message"] = "✓ Промпт улучшен!"
+        enhanced = await enhance_prompt(user_prompt, style_suffix)
+        
+        job.update(
+            enhanced_prompt=enhanced,
+            progress=40,
+            message="✓ Промпт улучшен!"
+        )
         
         # Шаг 2: Генерация изображения
-        generation_status["status"] = "generating"
-        generation_status["progress"] = 60
-        generation_status["message"] = f"🎨 Генерируем изображение через {provider.upper()}..."
+        job.update(
+            status="generating",
+            progress=60,
+            message=f"🎨 Генерируем изображение через {provider.upper()}..."
+        )
         
-        image_path = generate_image(enhanced, provider)
+        image_paths = await generate_images(enhanced, count, provider)
         
         # Готово
-        generation_status["status"] = "done"
-        generation_status["progress"] = 100
-        generation_status["message"] = "✓ Изображение готово!"
-        generation_status["image_path"] = str(image_path)
+        job.update(
+            status="done",
+            progress=100,
+            message="✓ Изображение готово!",
+            image_path=str(image_paths[0]),
+            image_paths=[str(p) for p in image_paths]
+        )
         
     except Exception as e:
-        generation_status["status"] = "error"
-        generation_status["error"] = str(e)
-        generation_status["message"] = f"✗ Ошибка: {str(e)}"
+        job.update(
+            status="error",
+            error=str(e),
+            message=f"✗ Ошибка: {str(e)}"
+        )
+    finally:
+        # Черновик нужен только до основного результата
+        if draft_task is not None and not draft_task.done():
+            draft_task.cancel()
 
 
 @app.route('/api/status')
 def api_status():
     """Получение статуса генерации"""
-    return jsonify(generation_status)
+    job = JOBS.get(request.args.get('job_id', ''))
+    if job is None:
+        return jsonify({"error": "Задача не найдена"}), 404
+    return Response(job.to_json(), mimetype='application/json')
+
+
+@app.route('/api/events/<job_id>')
+def api_events(job_id):
+    """Поток статуса генерации (Server-Sent Events)"""
+    job = JOBS.get(job_id)
+    if job is None:
+        return jsonify({"error": "Задача не найдена"}), 404
+    
+    def stream():
+        version = -1
+        while True:
+            payload, finished, version = job.wait_for_update(version, EVENTS_KEEPALIVE)
+            if payload is None:
+                yield b": keep-alive\n\n"
+                continue
+            yield b"data: " + payload + b"\n\n"
+            if finished:
+                return
+    
+    return Response(
+        stream_with_context(stream()),
+        mimetype='text/event-stream',
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
 
 @app.route('/api/gallery')
 def api_gallery():
     """Получение списка последних сгенерированных изображений"""
+    sort = request.args.get('sort', 'mtime')
+    if sort not in GALLERY_SORT_KEYS:
+        return jsonify({"error": f"Неизвестная сортировка: {sort}"}), 400
+    return Response(_gallery_json(sort), mimetype='application/json')
+
+
+def _natural_key(entry):
+    """Ключ естественной сортировки имен: img2 < img10"""
+    # split с группой чередует текст и числа: нечетные элементы всегда \d+
+    parts = _NATURAL_SPLIT_RE.split(entry.name)
+    return [int(part) if i % 2 else part.lower() for i, part in enumerate(parts)]
+
+
+def _mtime_key(entry):
+    """Ключ сортировки по времени изменения"""
+    return entry.stat().st_mtime
+
+
+GALLERY_SORT_KEYS = {"mtime": _mtime_key, "name": _natural_key}
+
+
+@cached(cache=TTLCache(maxsize=len(GALLERY_SORT_KEYS), ttl=GALLERY_CACHE_TTL), lock=threading.Lock())
+def _gallery_json(sort):
+    """Собирает галерею, сканируя папки провайдеров параллельно"""
+    futures = [_gallery_executor.submit(_scan_gallery_dir, provider, sort) for provider in GALLERY_PROVIDERS]
     images = []
+    for future in futures:
+        images.extend(future.result())
+    return orjson.dumps(images)
+
+
+def _scan_gallery_dir(provider, sort):
+    """Возвращает 10 последних изображений провайдера (по времени или по имени)"""
+    img_dir = f"generated_images/{provider}"
+    if not os.path.isdir(img_dir):
+        return []
     
-    for provider in ["proxyapi", "openrouter"]:
-        img_dir = Path(f"generated_images/{provider}")
-        if img_dir.exists():
-            for img_file in sorted(img_dir.glob("*.png"), key=lambda x: x.stat().st_mtime, reverse=True)[:10]:
-                images.append({
-                    "path": str(img_file),
-                    "filename": img_file.name,
-                    "provider": provider
-                })
-    
-    return jsonify(images)
+    # scandir отдает тип файла без лишних stat(), а heapq не сортирует весь список
+    with os.scandir(img_dir) as it:
+        entries = [e for e in it if e.name.endswith('.png') and e.is_file(follow_symlinks=False)]
+    return [
+        {
+            "path": entry.path,
+            "filename": entry.name,
+            "provider": provider
+        }
+        for entry in heapq.nlargest(10, entries, key=GALLERY_SORT_KEYS[sort])
+    ]
 
 
 @app.route('/images/<provider>/<filename>')
 def serve_image(provider, filename):
     """Отдача сгенерированных изображений"""
-    return send_from_directory(f'generated_images/{provider}', filename)
+    if provider not in GALLERY_PROVIDERS:
+        abort(404)
+    
+    # Имена файлов уникальны, содержимое не меняется: кэшируем в браузере навсегда
+    response = send_from_directory(
+        f'generated_images/{provider}', filename,
+        conditional=True, etag=True, max_age=IMAGE_MAX_AGE
+    )
+    response.headers['Cache-Control'] = f'public, max-age={IMAGE_MAX_AGE}, immutable'
+    return response
 
 
 if __name__ == '__main__':
@@ -173,7 +397,8 @@ if __name__ == '__main__':
     print("=" * 60)
     print("\nServer started!")
     print("Open: http://localhost:5000")
+    print("For production use: python wsgi.py")
     print("\n" + "=" * 60)
     
-    app.run(debug=True, host='0.0.0.0', port=5000)
+    app.run(host='0.0.0.0', port=5000, threaded=True)
 
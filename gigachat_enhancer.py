@@ -4,38 +4,50 @@
 """
 
 import os
+import asyncio
+import hashlib
+import functools
+from cachetools import TTLCache
 from gigachat import GigaChat
 
 
+# Кэш улучшенных промптов: повторный запрос не ходит в GigaChat.
+# enhance_prompt выполняется в одном event loop, поэтому блокировка не нужна.
+_enhance_cache = TTLCache(maxsize=512, ttl=3600)
+
+# Ограничение одновременных запросов к GigaChat
+ENHANCE_SEM = asyncio.Semaphore(int(os.getenv("ENHANCE_CONCURRENCY", "3")))
+
+
+@functools.cache
 def get_gigachat_credentials():
-    """Получает ключ авторизации GigaChat из переменной окружения"""
+    """Получает ключ авторизации GigaChat из переменной окружения (читается один раз)"""
     credentials = os.getenv("GIGACHAT_AUTH_KEY")
     if not credentials:
         raise ValueError("GIGACHAT_AUTH_KEY не установлен в .env")
     return credentials
 
 
-def enhance_prompt(simple_prompt, style_suffix="", max_length=250):
+@functools.lru_cache(maxsize=None)
+def _get_gigachat():
     """
-    Улучшает простой промпт через GigaChat для генерации изображений
+    Возвращает общий клиент GigaChat
     
-    Args:
-        simple_prompt: Простой промпт от пользователя
-        style_suffix: Дополнение стиля к промпту
-        max_length: Максимальная длина улучшенного промпта
-        
-    Returns:
-        str: Улучшенный детализированный промпт
+    Один долгоживущий клиент хранит токен доступа и соединения,
+    поэтому токен не запрашивается заново при каждом улучшении.
     """
-    try:
-        credentials = get_gigachat_credentials()
-        
-        with GigaChat(
-            credentials=credentials, 
-            verify_ssl_certs=False,
-            model="GigaChat"
-        ) as giga:
-            system_instruction = f"""Ты - эксперт по созданию промптов для генерации изображений.
+    return GigaChat(
+        credentials=get_gigachat_credentials(),
+        verify_ssl_certs=False,
+        model="GigaChat"
+    )
+
+
+@functools.lru_cache(maxsize=64)
+def _system_instruction(style_suffix, max_length):
+    """Системная инструкция для GigaChat (строится один раз на стиль и длину)"""
+    style_line = f"ОБЯЗАТЕЛЬНО учти стиль: {style_suffix}" if style_suffix else ""
+    return f"""Ты - эксперт по созданию промптов для генерации изображений.
 Твоя задача: взять простой промпт и превратить его в КРАТКОЕ, но детализированное описание для AI-генератора.
 
 ВАЖНО: Ответ должен быть не длиннее {max_length} символов!
@@ -45,25 +57,53 @@ def enhance_prompt(simple_prompt, style_suffix="", max_length=250):
 - Освещение и настроение
 - Технические детали
 
-{f'ОБЯЗАТЕЛЬНО учти стиль: {style_suffix}' if style_suffix else ''}
+{style_line}
 
 Ответь ТОЛЬКО улучшенным промптом, БЕЗ пояснений и лишних слов."""
 
-            prompt = f"{system_instruction}\n\nПромпт: {simple_prompt}\n\nУлучшенный:"
-            
-            response = giga.chat(prompt)
-            enhanced = response.choices[0].message.content.strip()
-            
-            # Обрезаем если слишком длинный
-            if len(enhanced) > max_length:
-                enhanced = enhanced[:max_length].rsplit(' ', 1)[0] + "..."
-            
-            # Добавляем стиль к улучшенному промпту
-            if style_suffix:
-                enhanced = f"{enhanced}, {style_suffix}"
-            
-            return enhanced
-            
+
+def _cache_key(simple_prompt, style_suffix, max_length):
+    """Ключ кэша улучшенных промптов"""
+    return hashlib.blake2b(f"{simple_prompt}|{style_suffix}|{max_length}".encode()).digest()
+
+
+async def enhance_prompt(simple_prompt, style_suffix="", max_length=250):
+    """
+    Улучшает простой промпт через GigaChat для генерации изображений
+    
+    Args:
+        simple_prompt: Простой промпт от пользователя
+        style_suffix: Дополнение стиля к промпту
+        max_length: Максимальная длина улучшенного промпта
+        
+    Returns:
+        str: Улучшенный детализированный промпт
+    """
+    cache_key = _cache_key(simple_prompt, style_suffix, max_length)
+    cached = _enhance_cache.get(cache_key)
+    if cached is not None:
+        return cached
+    
+    try:
+        giga = _get_gigachat()
+        
+        prompt = f"{_system_instruction(style_suffix, max_length)}\n\nПромпт: {simple_prompt}\n\nУлучшенный:"
+        
+        async with ENHANCE_SEM:
+            response = await giga.achat(prompt)
+        enhanced = response.choices[0].message.content.strip()
+        
+        # Обрезаем если слишком длинный
+        if len(enhanced) > max_length:
+            enhanced = enhanced[:max_length].rsplit(' ', 1)[0] + "..."
+        
+        # Добавляем стиль к улучшенному промпту
+        if style_suffix:
+            enhanced = f"{enhanced}, {style_suffix}"
+        
+        _enhance_cache[cache_key] = enhanced
+        return enhanced
+        
     except Exception as e:
         print(f"Ошибка GigaChat: {str(e)}")
         # Возвращаем оригинал + стиль
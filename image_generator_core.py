@@ -4,29 +4,231 @@
 """
 
 import os
+import time
 import base64
+import shutil
+import hashlib
+import asyncio
+import functools
+import itertools
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+import httpx
 import requests
-from datetime import datetime
 from pathlib import Path
-from openai import OpenAI
+from aiolimiter import AsyncLimiter
+from diskcache import Cache
 
 
+# Общие лимиты запросов к API генерации: число одновременных запросов
+# и частота (запросов в секунду), чтобы всплески не упирались в 429
+GENERATE_SEM = asyncio.Semaphore(int(os.getenv("GEN_CONCURRENCY", "5")))
+GENERATE_LIMITER = AsyncLimiter(int(os.getenv("GEN_RPS", "5")), 1)
+
+# Размер куска base64 при записи на диск (кратен 4)
+B64_CHUNK_SIZE = 64 * 1024
+
+
+class _FilenameTable(dict):
+    """
+    Таблица str.translate для имени файла
+    
+    Оставляет буквы и цифры любого алфавита (isalnum) и " -_",
+    остальные символы удаляет. Ответ для каждого символа кэшируется.
+    """
+
+    def __missing__(self, code):
+        char = chr(code)
+        value = code if char.isalnum() or char in " -_" else None
+        self[code] = value
+        return value
+
+
+_FILENAME_TRANS = _FilenameTable()
+
+# Счетчик имен файлов в процессе: next() атомарен, поэтому имена уникальны
+# даже при вызовах из разных потоков в пределах одного тика часов
+_filename_counter = itertools.count()
+
+# Кэш готовых изображений по (промпт, провайдер, номер варианта)
+IMAGE_CACHE_ENABLED = os.getenv("IMAGE_CACHE", "1") != "0"
+IMAGE_CACHE_DIR = ".image_cache"
+IMAGE_CACHE_SIZE_LIMIT = 5 * 1024 ** 3
+
+# Базовые URL OpenAI-совместимых API
+PROXYAPI_BASE_URL = "https://api.proxyapi.ru/openai/v1"
+OPENROUTER_BASE_URL = "https://openrouter.ai/api/v1"
+
+# Общий пул соединений HTTP/2 и таймауты (генерация может идти больше минуты)
+HTTP_LIMITS = httpx.Limits(max_connections=32, max_keepalive_connections=16)
+HTTP_TIMEOUT = httpx.Timeout(180.0, connect=10.0)
+
+# Повторы временных ошибок (как max_retries=2 в openai SDK)
+HTTP_MAX_RETRIES = 2
+HTTP_RETRY_STATUSES = frozenset({408, 409, 429})
+HTTP_RETRY_BACKOFF = 0.5
+HTTP_RETRY_MAX_DELAY = 8.0
+HTTP_RETRY_AFTER_MAX = 60.0
+
+
+@functools.cache
 def get_proxy_api_key():
-    """Получает ключ ProxyAPI из переменной окружения"""
+    """Получает ключ ProxyAPI из переменной окружения (читается один раз)"""
     api_key = os.getenv("PROXY_API")
     if not api_key:
         raise ValueError("PROXY_API не установлен в .env")
     return api_key
 
 
+@functools.cache
 def get_openrouter_api_key():
-    """Получает ключ OpenRouter из переменной окружения"""
+    """Получает ключ OpenRouter из переменной окружения (читается один раз)"""
     api_key = os.getenv("OPENROUTER_API_KEY")
     if not api_key:
         raise ValueError("OPENROUTER_API_KEY не установлен в .env")
     return api_key
 
 
+@functools.lru_cache(maxsize=None)
+def _get_http_client():
+    """
+    Возвращает общий асинхронный HTTP клиент
+    
+    Клиент создается один раз на процесс, поэтому TCP/TLS соединения
+    переиспользуются между запросами к обоим провайдерам.
+    """
+    return httpx.AsyncClient(http2=True, limits=HTTP_LIMITS, timeout=HTTP_TIMEOUT)
+
+
+def _retry_delay(attempt, response=None):
+    """Пауза перед повтором: Retry-After из ответа или экспоненциальная"""
+    retry_after = response.headers.get("Retry-After") if response is not None else None
+    if retry_after:
+        try:
+            delay = float(retry_after)
+        except ValueError:
+            try:
+                delay = (parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds()
+            except (TypeError, ValueError):
+                delay = None
+        if delay is not None and delay <= HTTP_RETRY_AFTER_MAX:
+            return max(delay, 0.0)
+    return min(HTTP_RETRY_BACKOFF * 2 ** attempt, HTTP_RETRY_MAX_DELAY)
+
+
+async def _post_json(url, api_key, payload):
+    """
+    Отправляет POST-запрос к OpenAI-совместимому API
+    
+    Ошибки соединения, 408/409/429 и 5xx повторяются до HTTP_MAX_RETRIES раз.
+    Каждая попытка проходит через общий ограничитель частоты GENERATE_LIMITER.
+    
+    Returns:
+        dict: JSON ответа
+    """
+    for attempt in range(HTTP_MAX_RETRIES + 1):
+        last_attempt = attempt == HTTP_MAX_RETRIES
+        try:
+            async with GENERATE_LIMITER:
+                response = await _get_http_client().post(
+                    url,
+                    headers={"Authorization": f"Bearer {api_key}"},
+                    json=payload
+                )
+        except httpx.TransportError as e:
+            if last_attempt:
+                raise ValueError(f"Ошибка соединения с API: {str(e) or type(e).__name__}") from e
+            await asyncio.sleep(_retry_delay(attempt))
+            continue
+        
+        retryable = response.status_code in HTTP_RETRY_STATUSES or response.status_code >= 500
+        if retryable and not last_attempt:
+            await asyncio.sleep(_retry_delay(attempt, response))
+            continue
+        if response.is_error:
+            raise ValueError(f"Ошибка API {response.status_code}: {response.text[:500]}")
+        
+        try:
+            return response.json()
+        except ValueError:
+            raise ValueError(f"Некорректный JSON в ответе API: {response.text[:500]}") from None
+
+
+def _response_excerpt(data):
+    """Начало ответа API для сообщения об ошибке"""
+    return str(data)[:500]
+
+
+def _write_base64(filepath, b64, start=0):
+    """
+    Декодирует base64 из строки b64 (начиная с позиции start) прямо в файл
+    
+    Декодирование идет кусками, поэтому в памяти одновременно живет
+    только один кусок декодированных данных, а не всё изображение.
+    """
+    # O_EXCL: никогда не перезаписываем чужой файл
+    flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0)
+    fd = os.open(filepath, flags, 0o644)
+    try:
+        for pos in range(start, len(b64), B64_CHUNK_SIZE):
+            view = memoryview(base64.b64decode(b64[pos:pos + B64_CHUNK_SIZE]))
+            while view:
+                written = os.write(fd, view)
+                view = view[written:]
+    except Exception:
+        # Не оставляем в галерее битый файл
+        os.close(fd)
+        os.remove(filepath)
+        raise
+    os.close(fd)
+
+
+def _build_filename(prompt):
+    """
+    Формирует имя файла: время, уникальный суффикс и начало промпта
+    
+    Суффикс из наносекунд и счетчика процесса не дает двум генерациям
+    получить одно имя (на Windows time_ns тикает раз в ~15 мс).
+    """
+    safe_prompt = prompt[:30].translate(_FILENAME_TRANS).strip().replace(' ', '_')
+    timestamp = time.strftime("%Y%m%d_%H%M%S")
+    suffix = f"{time.time_ns() & 0xFFFFFF:06x}{next(_filename_counter):x}"
+    return f"{timestamp}_{suffix}_{safe_prompt}.png"
+
+
+@functools.lru_cache(maxsize=None)
+def _get_image_cache():
+    """Возвращает дисковый кэш изображений (LRU-вытеснение по размеру)"""
+    return Cache(IMAGE_CACHE_DIR, size_limit=IMAGE_CACHE_SIZE_LIMIT, eviction_policy="least-recently-used")
+
+
+def _image_cache_key(prompt, provider, variant):
+    """Ключ кэша изображений"""
+    return hashlib.blake2b(f"{prompt}|{provider}|{variant}".encode()).hexdigest()[:16]
+
+
+def _copy_from_image_cache(key, prompt, provider):
+    """
+    Копирует изображение из кэша под новым именем в папку провайдера
+    
+    Returns:
+        Path | None: Путь к копии или None, если в кэше нет
+    """
+    cached = _get_image_cache().get(key, read=True)
+    if cached is None:
+        return None
+    filepath = create_output_directory(provider) / _build_filename(prompt)
+    with cached, open(filepath, 'xb') as f:
+        shutil.copyfileobj(cached, f)
+    return filepath
+
+
+def _store_in_image_cache(key, filepath):
+    """Сохраняет сгенерированное изображение в кэш"""
+    with open(filepath, 'rb') as f:
+        _get_image_cache().set(key, f, read=True)
+
+
 def create_output_directory(provider="proxyapi"):
     """Создает директорию для сохранения изображений"""
     output_dir = Path(f"generated_images/{provider}")
@@ -34,7 +236,7 @@ def create_output_directory(provider="proxyapi"):
     return output_dir
 
 
-def generate_image_proxyapi(prompt, output_dir=None):
+async def generate_image_proxyapi(prompt, output_dir=None):
     """
     Генерирует изображение через ProxyAPI
     
@@ -49,65 +251,66 @@ def generate_image_proxyapi(prompt, output_dir=None):
         output_dir = create_output_directory("proxyapi")
     
     api_key = get_proxy_api_key()
-    client = OpenAI(
-        api_key=api_key,
-        base_url="https://api.proxyapi.ru/openai/v1"
-    )
+    async with GENERATE_SEM:
+        result = await _post_json(
+            f"{PROXYAPI_BASE_URL}/images/generations",
+            api_key,
+            {"model": "gpt-image-1", "prompt": prompt}
+        )
     
-    result = client.images.generate(
-        model="gpt-image-1",
-        prompt=prompt
-    )
-    
-    image_base64 = result.data[0].b64_json
-    image_bytes = base64.b64decode(image_base64)
+    try:
+        image_base64 = result["data"][0]["b64_json"]
+    except (KeyError, IndexError, TypeError):
+        image_base64 = None
+    if not isinstance(image_base64, str):
+        raise ValueError(f"Не удалось найти data[0].b64_json в ответе. Debug: {_response_excerpt(result)}")
     
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    safe_prompt = "".join(c for c in prompt[:30] if c.isalnum() or c in (' ', '-', '_')).strip()
-    safe_prompt = safe_prompt.replace(' ', '_')
-    filename = f"{timestamp}_{safe_prompt}.png"
-    filepath = output_dir / filename
+    filepath = output_dir / _build_filename(prompt)
     
-    with open(filepath, 'wb') as f:
-        f.write(image_bytes)
+    await asyncio.to_thread(_write_base64, filepath, image_base64)
     
     return filepath
 
 
+def _data_url_payload_start(url):
+    """Возвращает позицию начала base64-данных в data URL картинки или -1"""
+    if not url.startswith("data:image/"):
+        return -1
+    # Заголовок data URL заканчивается первой запятой, дальше только данные
+    comma = url.find(",")
+    if comma == -1 or not url.endswith(";base64", 0, comma):
+        return -1
+    return comma + 1
+
+
 def _extract_data_urls_from_message(message):
     """
-    Возвращает список data URL картинок из assistant message.
-    Поддерживает структуру OpenRouter: message.images[*].image_url.url
+    Возвращает список (data URL, позиция начала base64) картинок из assistant message.
+    Поддерживает структуру OpenRouter: message["images"][*]["image_url"]["url"]
+    
+    message - dict из JSON ответа (_post_json); CLI-скрипты с объектами
+    openai SDK используют собственные копии этой функции.
     """
     urls = []
 
-    images = getattr(message, "images", None)
-    if not images:
-        try:
-            md = message.model_dump()  # pydantic v2
-        except Exception:
-            md = message if isinstance(message, dict) else None
-        if md and isinstance(md, dict):
-            images = md.get("images")
-
+    images = message.get("images") if isinstance(message, dict) else None
     if not images:
         return urls
 
     for img in images:
-        # img может быть dict или объектом
-        if isinstance(img, dict):
-            url = (img.get("image_url") or {}).get("url")
-        else:
-            image_url = getattr(img, "image_url", None)
-            url = getattr(image_url, "url", None) if image_url else None
+        if not isinstance(img, dict):
+            continue
+        url = (img.get("image_url") or {}).get("url")
 
-        if url and isinstance(url, str) and url.startswith("data:image/") and "base64," in url:
-            urls.append(url)
+        if url and isinstance(url, str):
+            start = _data_url_payload_start(url)
+            if start != -1:
+                urls.append((url, start))
 
     return urls
 
 
-def generate_image_openrouter(prompt, output_dir=None):
+async def generate_image_openrouter(prompt, output_dir=None):
     """
     Генерирует изображение через OpenRouter (Nano Banana - Gemini 2.5 Flash Image)
     
@@ -122,61 +325,82 @@ def generate_image_openrouter(prompt, output_dir=None):
         output_dir = create_output_directory("openrouter")
     
     api_key = get_openrouter_api_key()
-    client = OpenAI(
-        api_key=api_key,
-        base_url="https://openrouter.ai/api/v1"
-    )
-    
-    # Используем Gemini 2.5 Flash Image (Nano Banana) для генерации
-    res = client.chat.completions.create(
-        model="google/gemini-2.5-flash-image",
-        messages=[{"role": "user", "content": prompt}],
-        modalities=["image", "text"]
-    )
+    async with GENERATE_SEM:
+        # Используем Gemini 2.5 Flash Image (Nano Banana) для генерации
+        res = await _post_json(
+            f"{OPENROUTER_BASE_URL}/chat/completions",
+            api_key,
+            {
+                "model": "google/gemini-2.5-flash-image",
+                "messages": [{"role": "user", "content": prompt}],
+                "modalities": ["image", "text"]
+            }
+        )
     
-    message = res.choices[0].message
+    try:
+        message = res["choices"][0]["message"]
+    except (KeyError, IndexError, TypeError):
+        raise ValueError(f"Не удалось найти choices[0].message в ответе. Debug: {_response_excerpt(res)}") from None
     data_urls = _extract_data_urls_from_message(message)
 
     if not data_urls:
-        try:
-            debug = message.model_dump()
-        except Exception:
-            debug = {"message_str": str(message)}
-        raise ValueError(f"Не удалось найти images[].image_url.url в ответе. Debug: {debug}")
+        raise ValueError(f"Не удалось найти images[].image_url.url в ответе. Debug: {_response_excerpt(message)}")
 
-    data_url = data_urls[0]
-    
-    # Декодируем base64
-    b64 = data_url.split("base64,", 1)[1]
-    image_bytes = base64.b64decode(b64)
+    data_url, b64_start = data_urls[0]
     
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    safe_prompt = "".join(c for c in prompt[:30] if c.isalnum() or c in (' ', '-', '_')).strip()
-    safe_prompt = safe_prompt.replace(' ', '_')
-    filename = f"{timestamp}_{safe_prompt}.png"
-    filepath = output_dir / filename
+    filepath = output_dir / _build_filename(prompt)
     
-    with open(filepath, 'wb') as f:
-        f.write(image_bytes)
+    await asyncio.to_thread(_write_base64, filepath, data_url, b64_start)
     
     return filepath
 
 
-def generate_image(prompt, provider="proxyapi"):
+async def generate_image(prompt, provider="proxyapi", variant=0):
     """
     Универсальная функция генерации изображений
     
+    Повторный запрос с тем же промптом отдается из кэша: готовое
+    изображение копируется под новым именем, API не вызывается.
+    
     Args:
         prompt: Промпт для генерации
         provider: "proxyapi" или "openrouter"
+        variant: Номер варианта (разные варианты кэшируются отдельно)
         
     Returns:
         Path: Путь к сохраненному изображению
     """
     if provider == "proxyapi":
-        return generate_image_proxyapi(prompt)
+        generate = generate_image_proxyapi
     elif provider == "openrouter":
-        return generate_image_openrouter(prompt)
+        generate = generate_image_openrouter
     else:
         raise ValueError(f"Неизвестный провайдер: {provider}")
+    
+    if not IMAGE_CACHE_ENABLED:
+        return await generate(prompt)
+    
+    key = _image_cache_key(prompt, provider, variant)
+    filepath = await asyncio.to_thread(_copy_from_image_cache, key, prompt, provider)
+    if filepath is None:
+        filepath = await generate(prompt)
+        await asyncio.to_thread(_store_in_image_cache, key, filepath)
+    return filepath
+
 
+async def generate_images(prompt, count=1, provider="proxyapi"):
+    """
+    Генерирует несколько изображений по одному промпту параллельно
+    
+    Args:
+        prompt: Промпт для генерации
+        count: Количество изображений
+        provider: "proxyapi" или "openrouter"
+        
+    Returns:
+        list[Path]: Пути к сохраненным изображениям
+    """
+    paths = await asyncio.gather(
+        *(generate_image(prompt, provider, variant) for variant in range(count))
+    )
+    return list(paths)
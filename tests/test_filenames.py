@@ -0,0 +1,24 @@
+"""Тесты имен сохраняемых файлов"""
+
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from image_generator_core import _build_filename
+
+
+def _prompt_part(filename):
+    # YYYYMMDD_HHMMSS_суффикс_промпт.png
+    return filename.split("_", 3)[3][:-len(".png")]
+
+
+def test_filename_keeps_only_alnum_and_separators():
+    prompt = "Привет, мир! «тест» — 😀‮ x/y:z"
+    expected = "".join(c for c in prompt[:30] if c.isalnum() or c in (" ", "-", "_")).strip().replace(" ", "_")
+    assert _prompt_part(_build_filename(prompt)) == expected == "Привет_мир_тест__xyz"
+
+
+def test_filenames_are_unique():
+    names = {_build_filename("cat") for _ in range(1000)}
+    assert len(names) == 1000
@@ -0,0 +1,23 @@
+"""Тесты сортировки галереи"""
+
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from app import _natural_key
+
+
+def _names_sorted(names):
+    return [e.name for e in sorted((SimpleNamespace(name=n) for n in names), key=_natural_key)]
+
+
+def test_natural_key_orders_numbers_by_value():
+    assert _names_sorted(["img10.png", "img2.png", "IMG1.png"]) == ["IMG1.png", "img2.png", "img10.png"]
+
+
+def test_natural_key_handles_non_decimal_digits():
+    # '²'.isdigit() истинно, но int('²') падает: такие символы не числа
+    assert _natural_key(SimpleNamespace(name="x1²2.png")) == ["x", 1, "²", 2, ".png"]
+    assert _names_sorted(["x1²2.png", "x1²10.png", "x1.png"]) == ["x1.png", "x1²2.png", "x1²10.png"]
@@ -0,0 +1,82 @@
+"""Тесты запросов к API генерации"""
+
+import asyncio
+import sys
+from pathlib import Path
+
+import httpx
+import pytest
+from aiolimiter import AsyncLimiter
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import image_generator_core as core
+
+
+@pytest.fixture
+def mock_api(monkeypatch):
+    """Подменяет HTTP клиент: handler получает номер попытки"""
+    calls = []
+
+    def install(handler):
+        def transport(request):
+            calls.append(request)
+            return handler(len(calls))
+        client = httpx.AsyncClient(transport=httpx.MockTransport(transport))
+        monkeypatch.setattr(core, "_get_http_client", lambda: client)
+        monkeypatch.setattr(core, "HTTP_RETRY_BACKOFF", 0)
+        # asyncio.run создает новый loop на каждый тест
+        monkeypatch.setattr(core, "GENERATE_LIMITER", AsyncLimiter(100, 1))
+        monkeypatch.setattr(core, "GENERATE_SEM", asyncio.Semaphore(5))
+        return calls
+
+    return install
+
+
+def _post():
+    return asyncio.run(core._post_json("https://api.test/v1/x", "key", {}))
+
+
+def test_retries_transient_errors(mock_api):
+    def handler(attempt):
+        if attempt == 1:
+            return httpx.Response(429, headers={"Retry-After": "0"})
+        if attempt == 2:
+            return httpx.Response(502)
+        return httpx.Response(200, json={"ok": True})
+
+    calls = mock_api(handler)
+    assert _post() == {"ok": True}
+    assert len(calls) == 3
+
+
+def test_gives_up_after_max_retries(mock_api):
+    calls = mock_api(lambda attempt: httpx.Response(503, text="busy"))
+    with pytest.raises(ValueError, match="Ошибка API 503: busy"):
+        _post()
+    assert len(calls) == core.HTTP_MAX_RETRIES + 1
+
+
+def test_does_not_retry_client_errors(mock_api):
+    calls = mock_api(lambda attempt: httpx.Response(400, text="bad prompt"))
+    with pytest.raises(ValueError, match="400"):
+        _post()
+    assert len(calls) == 1
+
+
+def test_retries_connection_errors(mock_api):
+    def handler(attempt):
+        if attempt == 1:
+            raise httpx.ConnectError("reset")
+        return httpx.Response(200, json={"ok": True})
+
+    mock_api(handler)
+    assert _post() == {"ok": True}
+
+
+def test_malformed_image_response_is_value_error(mock_api, tmp_path, monkeypatch):
+    monkeypatch.setenv("PROXY_API", "key")
+    core.get_proxy_api_key.cache_clear()
+    mock_api(lambda attempt: httpx.Response(200, json={"data": [{}]}))
+    with pytest.raises(ValueError, match="b64_json"):
+        asyncio.run(core.generate_image_proxyapi("cat", tmp_path))
@@ -0,0 +1,22 @@
+#!/usr/bin/env python3
+"""
+WSGI точка входа для продакшн-сервера
+
+Задачи генерации и их event loop живут в памяти процесса, поэтому
+сервер запускается одним процессом с большим числом потоков:
+
+    python wsgi.py                                  # waitress (Windows/Linux/Mac)
+    gunicorn -w 1 -k gthread --threads 32 wsgi:app  # Linux/Mac
+"""
+
+from app import app
+
+# Потоки обслуживают запросы и SSE-подписки, генерации идут в event loop
+SERVER_THREADS = 32
+
+
+if __name__ == '__main__':
+    from waitress import serve
+
+    print("AI Image Generator: http://localhost:5000")
+    serve(app, host='0.0.0.0', port=5000, threads=SERVER_THREADS)